@@ -1,10 +1,10 @@
 import asyncio
 import json
 import os
-import re
 import sys
+import threading
 from contextlib import AsyncExitStack
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 # from anthropic import Anthropic
 from dotenv import load_dotenv
@@ -13,8 +13,202 @@ from google.genai import types
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
 
+try:
+    import orjson
+except ImportError:  # fall back to the standard library
+    orjson = None
+
 load_dotenv()  # load environment variables from .env
 
+# Tags wrapping each tool call in Gemini's response
+_TOOL_CALL_OPEN = "<tool_call>"
+_TOOL_CALL_CLOSE = "</tool_call>"
+
+# Output token caps: the first turn mostly picks tools, answers can be long
+_TOOLPICK_MAX_TOKENS = 512
+_ANSWER_MAX_TOKENS = 8192
+
+# Sent when a first-turn answer hits the tool-picking token cap
+_CONTINUE_PROMPT = "Continue exactly where you left off."
+
+# System instruction around the tools description
+_PROMPT_HEAD = """You are a helpful assistant that can use tools to answer questions.
+When you need to use a tool, respond with:
+<tool_call>
+{"name": "tool_name", "input": {"parameter1": "value1"}}
+</tool_call>
+
+"""
+_PROMPT_TAIL = """
+- If the user query does not need a tool, answer in natural language.
+- Always wrap tool calls in literal "<tool_call>" and "</tool_call>" tags.
+"""
+
+# Follow-up prompt around the query and the tool results
+_TOOL_RESULTS_HEAD = "You previously used tools to answer the query: "
+_TOOL_RESULTS_TAIL = "\n\nPlease provide a helpful response based on this information."
+
+# Schema descriptions longer than this are left out of the prompt
+_MAX_SCHEMA_DESCRIPTION = 120
+
+# Canned replies for greetings and thanks that need no model call
+_GREETING_REPLY = "Hello! How can I help you?"
+_THANKS_REPLY = "You're welcome! Let me know if you need anything else."
+_CANNED_REPLIES = {
+    "hi": _GREETING_REPLY,
+    "hello": _GREETING_REPLY,
+    "hey": _GREETING_REPLY,
+    "thanks": _THANKS_REPLY,
+    "thank you": _THANKS_REPLY,
+    "thx": _THANKS_REPLY,
+}
+
+
+def _json_dumps(obj: Any) -> str:
+    """Serialize obj to a JSON string, using orjson when available"""
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(",", ":"))
+
+
+def _json_loads(data: str) -> Any:
+    """Deserialize a JSON string, using orjson when available"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _response_text(response: types.GenerateContentResponse) -> str:
+    """Join the text parts of a response's first candidate
+
+    Reads the parts directly instead of the response.text property, which
+    re-walks the candidates on every access.
+    """
+    if not response.candidates:
+        return ""
+    content = response.candidates[0].content
+    if content is None or not content.parts:
+        return ""
+    return "".join(part.text for part in content.parts if part.text)
+
+
+def _compact_schema(schema: Any) -> Any:
+    """Copy a JSON Schema without its overly long description fields"""
+    if isinstance(schema, dict):
+        return {
+            key: _compact_schema(value)
+            for key, value in schema.items()
+            if not (
+                key == "description"
+                and isinstance(value, str)
+                and len(value) > _MAX_SCHEMA_DESCRIPTION
+            )
+        }
+    if isinstance(schema, list):
+        return [_compact_schema(value) for value in schema]
+    return schema
+
+
+def _trivial_reply(query: str) -> Optional[str]:
+    """Return a canned reply if the query is a greeting or thanks"""
+    return _CANNED_REPLIES.get(query.rstrip("!. ").lower())
+
+
+async def _read_line() -> str:
+    """Read a line from stdin without blocking the event loop
+
+    The read runs in a daemon thread rather than the default executor, whose
+    shutdown would otherwise wait for a pending read when the loop exits.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def deliver(line: Optional[str], error: Optional[BaseException]):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(line)
+
+    def read():
+        # Hand errors back too, or the awaiting coroutine would wait forever
+        try:
+            line = sys.stdin.readline()
+        except Exception as e:
+            loop.call_soon_threadsafe(deliver, None, e)
+        else:
+            loop.call_soon_threadsafe(deliver, line, None)
+
+    threading.Thread(target=read, daemon=True).start()
+    return await future
+
+
+class _ToolCallScanner:
+    """Split streamed text into plain text and tool call bodies
+
+    Only the unfinished tail of the stream is buffered, so each chunk is
+    scanned once no matter how long the response grows.
+    """
+
+    def __init__(self):
+        self._pending = ""
+        self._in_call = False
+
+    def feed(self, chunk: str) -> Tuple[str, List[str]]:
+        """Scan the next chunk
+
+        Returns:
+            The text outside tool call tags and the bodies of the tool calls
+            completed by this chunk
+        """
+        # Tags already ruled out in the pending text need not be searched again
+        pos = 0
+        search_from = max(0, len(self._pending) - len(_TOOL_CALL_CLOSE) + 1)
+        text = self._pending + chunk
+        visible = []
+        bodies = []
+        while True:
+            if self._in_call:
+                end = text.find(_TOOL_CALL_CLOSE, max(pos, search_from))
+                if end < 0:
+                    break
+                bodies.append(text[pos:end])
+                pos = end + len(_TOOL_CALL_CLOSE)
+                self._in_call = False
+            else:
+                start = text.find(_TOOL_CALL_OPEN, pos)
+                if start < 0:
+                    # Hold back a trailing prefix of the opening tag
+                    keep = len(_TOOL_CALL_OPEN) - 1
+                    while keep and not text.endswith(_TOOL_CALL_OPEN[:keep]):
+                        keep -= 1
+                    visible.append(text[pos : len(text) - keep])
+                    pos = len(text) - keep
+                    break
+                visible.append(text[pos:start])
+                pos = start + len(_TOOL_CALL_OPEN)
+                self._in_call = True
+        self._pending = text[pos:]
+        return "".join(visible), bodies
+
+    @property
+    def in_call(self) -> bool:
+        """Whether the text so far ends inside an unclosed tool call"""
+        return self._in_call
+
+    def flush(self) -> str:
+        """Return the held back text once the stream has ended
+
+        The body of an unclosed tool call is reported and dropped.
+        """
+        if self._in_call:
+            print(f"Tool call was cut off: {self._pending}")
+        pending = "" if self._in_call else self._pending
+        self._pending = ""
+        self._in_call = False
+        return pending
+
 
 class MCPClient:
     def __init__(self):
@@ -31,13 +225,23 @@ class MCPClient:
 
         self.model = "gemini-2.0-flash-001"
 
+        # Configuration for Gemini (connect_tools adds the system instruction)
         self.generate_config = types.GenerateContentConfig(
             temperature=0,
             top_p=0.95,
-            max_output_tokens=8192,
+            max_output_tokens=_ANSWER_MAX_TOKENS,
             response_modalities=["TEXT"],
         )
 
+        # Tools and prompt preamble, cached by connect_tools
+        self._tools_payload: List[Dict[str, Any]] = []
+        self._tools_description = ""
+        self._system_preamble = ""
+        self._cfg_toolpick = self.generate_config
+
+        # Persistent chat session, created by connect_tools
+        self.chat = None
+
     async def connect_to_server(self, server_script_path: str):
         """Connect to an MCP server
 
@@ -64,133 +268,205 @@ class MCPClient:
 
         await self.session.initialize()
 
-        # List available tools
-        response = await self.session.list_tools()
-        tools = response.tools
-        print("\nConnected to server with tools:", [tool.name for tool in tools])
-
-    async def process_query(self, query: str) -> str:
-        """Process a query using Claude and available tools"""
+        # Cache the tools and the prompt preamble built from them
+        await self.connect_tools()
 
-        # Keep track of the conversation
-        self.conversation_history = []
-
-        # Add user query to conversation history
-        self.conversation_history.append({"role": "user", "content": query})
+    async def connect_tools(self):
+        """Fetch the MCP tools and build the prompt preamble describing them
 
+        The tool roster is static for the life of the MCP session, so this runs
+        once on connect. Call it again if the server's tool list changes.
+        """
         # Get available tools
         response = await self.session.list_tools()
-        available_tools = [
+        # Gemini-facing tools, with compact schemas to save prompt tokens
+        self._tools_payload = [
             {
                 "name": tool.name,
                 "description": tool.description,
-                "input_schema": tool.inputSchema,
+                "input_schema": _compact_schema(tool.inputSchema),
             }
             for tool in response.tools
         ]
 
         # Format tools for Gemini
-
         tools_description = "Available tools:\n"
-        for tool in available_tools:
+        for tool in self._tools_payload:
+            input_schema = _json_dumps(tool["input_schema"])
             tools_description += f"- {tool['name']}: {tool['description']}\n"
-            tools_description += (
-                f"  Input schema: {json.dumps(tool['input_schema'])}\n\n"
-            )
+            tools_description += f"  Input schema: {input_schema}\n"
+        self._tools_description = tools_description
+
+        # The invariant instructions go in the system instruction, so Gemini can
+        # reuse the prefix across turns and only the user query is sent per turn
+        self._system_preamble = _PROMPT_HEAD + tools_description + _PROMPT_TAIL
+
+        self.generate_config = self.generate_config.model_copy(
+            update={"system_instruction": self._system_preamble}
+        )
 
-        # Initial Gemini API call
-        gemini_prompt = f"""
-        You are a helpful assistant that can use tools to answer questions.
-        When you need to use a tool, format your response as follows:
-        
-        <tool_call>
-        {{
-            "name": "tool_name",
-            "input": {{
-                "parameter1": "value1",
-                "parameter2": "value2"
-            }}
-        }}
-        </tool_call>
-        
-        After using a tool, provide a natural language response based on the tool results.
-        
-        {tools_description}
-
-        - If the user query does not indicate the need to use a tool, provide a natural language response.
-        - Remember to wrap all tool calls with "<tool_call>" {{JSON representing the tool call}} "</tool_call>" tags.
-        - It's important to use the XML-like syntax for the tags, with "<TAG_NAME>" and "</TAG_NAME>" tags.
-        
-        
-        User query: {query}
+        # The first turn usually just picks tools, so it gets a small output cap.
+        # Direct answers that hit the cap are continued with the full budget.
+        self._cfg_toolpick = self.generate_config.model_copy(
+            update={"max_output_tokens": _TOOLPICK_MAX_TOKENS}
+        )
+
+        # Keep one chat across queries so Gemini extends the same context instead
+        # of starting from scratch every turn
+        self.chat = self.genai_client.aio.chats.create(
+            model=self.model, config=self.generate_config
+        )
+
+        print(
+            "\nConnected to server with tools:",
+            [tool["name"] for tool in self._tools_payload],
+        )
+
+    async def process_query(
+        self, query: str, on_text: Optional[Callable[[str], None]] = None
+    ) -> str:
+        """Process a query using Claude and available tools
+
+        Args:
+            query: The user query
+            on_text: Optional callback receiving the response as it streams in,
+                without the tool call markup
         """
 
-        # Create Gemini content
-        contents = [types.Content(role="user", parts=[types.Part(text=gemini_prompt)])]
+        # Keep track of the conversation
+        self.conversation_history = []
+
+        # Add user query to conversation history
+        self.conversation_history.append({"role": "user", "content": query})
+
+        # Skip Gemini entirely for greetings and thanks
+        reply = _trivial_reply(query)
+        if reply is not None:
+            return reply
+
+        # Start each tool call as soon as its closing tag has streamed in, and
+        # forward only the text outside the tool call tags
+        tool_tasks: List[asyncio.Task] = []
+        scanner = _ToolCallScanner()
+        visible: List[str] = []
+
+        def emit(text: str):
+            visible.append(text)
+            if on_text is not None and text:
+                on_text(text)
+
+        def on_chunk(chunk_text: str):
+            text, bodies = scanner.feed(chunk_text)
+            emit(text)
+            for tool_call in self._parse_tool_calls(bodies):
+                tool_tasks.append(asyncio.create_task(self._run_single_tool(tool_call)))
 
         # Get response from Gemini
-        response = await self._generate_content(contents)
+        try:
+            _, finish_reason = await self._generate_content(
+                query, self._cfg_toolpick, on_chunk
+            )
+
+            # Continue an answer or tool call cut off by the tool-picking token cap
+            if finish_reason == types.FinishReason.MAX_TOKENS and (
+                not tool_tasks or scanner.in_call
+            ):
+                await self._generate_content(
+                    _CONTINUE_PROMPT, self.generate_config, on_chunk
+                )
+            emit(scanner.flush())
+        except BaseException:
+            for task in tool_tasks:
+                task.cancel()
+            raise
 
-        # Parse response for tool calls
         final_text = []
-        tool_calls = self._extract_tool_calls(response)
-        print(tool_calls)
-
-        if tool_calls:
-            for tool_call in tool_calls:
-                try:
-                    tool_name = tool_call["name"]
-                    tool_args = tool_call["input"]
-
-                    # Execute tool call
-                    result = await self.session.call_tool(tool_name, tool_args)
-                    final_text.append(
-                        f"[Calling tool {tool_name} with args {tool_args}]"
-                    )
-
-                    # Use the tool result to get a final response
-                    tool_result_prompt = f"""
-                    You previously used the tool {tool_name} to answer the query: {query}
-                    
-                    The tool returned this result: {result.content}
-                    
-                    Please provide a helpful response based on this information.
-                    """
-
-                    # Create Gemini content for tool result
-                    tool_contents = [
-                        types.Content(
-                            role="user", parts=[types.Part(text=tool_result_prompt)]
-                        )
-                    ]
-
-                    # Get final response from Gemini
-                    final_response = await self._generate_content(tool_contents)
-                    final_text.append(final_response)
-                except Exception as e:
-                    final_text.append(f"Error executing tool {tool_name}: {str(e)}")
+        if tool_tasks:
+            # Wait for the tool calls, keeping the original order
+            tool_results = []
+            for tool_text, tool_result in await asyncio.gather(*tool_tasks):
+                final_text.append(tool_text)
+                if tool_result is not None:
+                    tool_results.append(tool_result)
+            if on_text is not None:
+                on_text("\n" + "\n".join(final_text) + "\n")
+
+            # Use all the tool results to get a single final response
+            if tool_results:
+                tool_result_prompt = (
+                    _TOOL_RESULTS_HEAD
+                    + query
+                    + "\n\n"
+                    + "\n\n".join(tool_results)
+                    + _TOOL_RESULTS_TAIL
+                )
+                final_response, _ = await self._generate_content(
+                    tool_result_prompt, self.generate_config, on_text
+                )
+                final_text.append(final_response)
         else:
             # If no tool calls, just use the response directly
             print("\n\nNo tool calls were detected.\n\n")
-            final_text.append(response)
+            final_text.append("".join(visible))
 
         return "\n".join(final_text)
 
-    async def _generate_content(self, contents: List[types.Content]) -> str:
-        """Generate content using Gemini"""
-        response = self.genai_client.models.generate_content(
-            model=self.model,
-            contents=contents,
-            config=self.generate_config,
-        )
-        return response.text
+    async def _run_single_tool(
+        self, tool_call: Dict[str, Any]
+    ) -> Tuple[str, Optional[str]]:
+        """Execute a single tool call
 
-    def _extract_tool_calls(self, text: str) -> List[Dict[str, Any]]:
-        """Extract tool calls from Gemini response"""
-        tool_calls = []
+        Returns:
+            The line reporting the call to the user and the tool result to pass
+            back to Gemini, or None if the call failed.
+        """
+        tool_name = None
+        try:
+            tool_name = tool_call["name"]
+            tool_args = tool_call["input"]
+
+            # Execute tool call
+            result = await self.session.call_tool(tool_name, tool_args)
+            return (
+                f"[Calling tool {tool_name} with args {tool_args}]",
+                f"The tool {tool_name} returned this result: {result.content}",
+            )
+        except Exception as e:
+            return f"Error executing tool {tool_name}: {str(e)}", None
 
-        # Look for tool call format with the format
-        # <tool_call>
+    async def _generate_content(
+        self,
+        message: str,
+        config: types.GenerateContentConfig,
+        on_chunk: Optional[Callable[[str], None]] = None,
+    ) -> Tuple[str, Optional[types.FinishReason]]:
+        """Send a message on the Gemini chat, streaming the response
+
+        Args:
+            message: The message to send to Gemini
+            config: The generation config to use
+            on_chunk: Optional callback receiving each chunk of text as it arrives
+
+        Returns:
+            The generated text and the reason generation finished
+        """
+        chunks = []
+        finish_reason = None
+        async for chunk in await self.chat.send_message_stream(message, config=config):
+            candidate = chunk.candidates[0] if chunk.candidates else None
+            if candidate is not None and candidate.finish_reason:
+                finish_reason = candidate.finish_reason
+            chunk_text = _response_text(chunk)
+            if not chunk_text:
+                continue
+            chunks.append(chunk_text)
+            if on_chunk is not None:
+                on_chunk(chunk_text)
+        return "".join(chunks), finish_reason
+
+    def _parse_tool_calls(self, bodies: List[str]) -> List[Dict[str, Any]]:
+        """Parse tool call bodies, skipping the malformed ones"""
+        # Each body between the tags has the format
         # {
         #   "name": "tool_name",
         #   "input": {
@@ -198,18 +474,18 @@ class MCPClient:
         #     "parameter2": "value2"
         #   }
         # }
-        # </tool_call>
-
-        pattern = r"<?tool_call>(.*?)</tool_call>"
-        matches = re.findall(pattern, text, re.DOTALL)
-
-        for match in matches:
+        tool_calls = []
+        for body in bodies:
+            # JSON parsers skip surrounding whitespace, so no strip() copy is needed
             try:
-                tool_call = json.loads(match.strip())
-                tool_calls.append(tool_call)
+                tool_call = _json_loads(body)
             except json.JSONDecodeError:
-                print(f"Failed to parse tool call: {match}")
-
+                print(f"Failed to parse tool call: {body}")
+                continue
+            if not isinstance(tool_call, dict):
+                print(f"Tool call is not a JSON object: {body}")
+                continue
+            tool_calls.append(tool_call)
         return tool_calls
 
     async def chat_loop(self):
@@ -219,12 +495,31 @@ class MCPClient:
 
         while True:
             try:
-                query = input("\nQuery: ").strip()
+                # Read stdin in a thread so background tasks keep running
+                print("\nQuery: ", end="", flush=True)
+                line = await _read_line()
+                if not line:  # EOF
+                    break
+                query = line.strip()
                 if query.lower() == "quit":
                     break
 
-                response = await self.process_query(query)
-                print("\n" + response)
+                # Print Gemini's response live as it streams in
+                streamed = False
+
+                def print_chunk(chunk_text: str):
+                    nonlocal streamed
+                    if not streamed:
+                        print()
+                        streamed = True
+                    print(chunk_text, end="", flush=True)
+
+                response = await self.process_query(query, on_text=print_chunk)
+                if streamed:
+                    print()
+                else:
+                    # Canned replies are returned without streaming
+                    print("\n" + response)
             except Exception as e:
                 print(f"\nError: {str(e)}")
 
@@ -2,8 +2,11 @@ import asyncio
 import json
 import os
 import sys
+import threading
+import time
 from contextlib import AsyncExitStack
-from typing import Dict, Optional
+from types import MappingProxyType
+from typing import Any, Dict, Optional
 
 from dotenv import load_dotenv
 from google import genai
@@ -11,9 +14,123 @@ from google.genai import types
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
 
+try:
+    import orjson
+except ImportError:  # fall back to the standard library
+    orjson = None
+
 load_dotenv()  # load environment variables from .env
 
 
+def _json_dumps(obj: Any) -> str:
+    """Serialize obj to a JSON string, using orjson when available"""
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(",", ":"))
+
+
+# JSON Schema types and their Gemini Schema equivalents
+_JSON_TO_GEMINI = MappingProxyType(
+    {
+        "string": "STRING",
+        "number": "NUMBER",
+        "integer": "INTEGER",
+        "boolean": "BOOLEAN",
+        "object": "OBJECT",
+        "array": "ARRAY",
+    }
+)
+
+
+def _map_json_schema_type(json_type: str) -> str:
+    """Map JSON Schema types to Gemini Schema types"""
+    return _JSON_TO_GEMINI.get(json_type, "STRING")
+
+
+# Output token caps: the first turn mostly picks tools, answers can be long
+_TOOLPICK_MAX_TOKENS = 512
+_ANSWER_MAX_TOKENS = 8192
+
+# Sent when a first-turn answer hits the tool-picking token cap
+_CONTINUE_PROMPT = "Continue exactly where you left off."
+
+# Instructions for the assistant, sent as the system instruction
+_SYSTEM_INSTRUCTIONS = (
+    "You are a helpful assistant with access to various tools. When a user's "
+    "query requires the use of a tool, use the appropriate tool to address their "
+    "needs. Do not suggest using a tool when it's not necessary and answer "
+    "queries not related to tools naturally."
+)
+
+# Follow-up message around the query and the tool results
+_TOOL_RESULTS_HEAD = "You used tools to answer the query: "
+_TOOL_RESULTS_TAIL = "\n\nPlease provide a helpful response based on this information."
+
+# Lifetime of the Vertex context cache holding the system instructions and tools
+_CACHE_TTL_SECONDS = 3600
+
+# Canned replies for greetings and thanks that need no model call
+_GREETING_REPLY = "Hello! How can I help you?"
+_THANKS_REPLY = "You're welcome! Let me know if you need anything else."
+_CANNED_REPLIES = {
+    "hi": _GREETING_REPLY,
+    "hello": _GREETING_REPLY,
+    "hey": _GREETING_REPLY,
+    "thanks": _THANKS_REPLY,
+    "thank you": _THANKS_REPLY,
+    "thx": _THANKS_REPLY,
+}
+
+
+def _response_text(response: types.GenerateContentResponse) -> str:
+    """Join the text parts of a response's first candidate
+
+    Reads the parts directly instead of the response.text property, which
+    re-walks the candidates on every access.
+    """
+    if not response.candidates:
+        return ""
+    content = response.candidates[0].content
+    if content is None or not content.parts:
+        return ""
+    return "".join(part.text for part in content.parts if part.text)
+
+
+def _trivial_reply(query: str) -> Optional[str]:
+    """Return a canned reply if the query is a greeting or thanks"""
+    return _CANNED_REPLIES.get(query.rstrip("!. ").lower())
+
+
+async def _read_line() -> str:
+    """Read a line from stdin without blocking the event loop
+
+    The read runs in a daemon thread rather than the default executor, whose
+    shutdown would otherwise wait for a pending read when the loop exits.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def deliver(line: Optional[str], error: Optional[BaseException]):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(line)
+
+    def read():
+        # Hand errors back too, or the awaiting coroutine would wait forever
+        try:
+            line = sys.stdin.readline()
+        except Exception as e:
+            loop.call_soon_threadsafe(deliver, None, e)
+        else:
+            loop.call_soon_threadsafe(deliver, line, None)
+
+    threading.Thread(target=read, daemon=True).start()
+    return await future
+
+
 class MCPClient:
     def __init__(self):
         # Initialize session and client objects
@@ -29,16 +146,24 @@ class MCPClient:
         self.model = "gemini-2.0-flash-001"
 
         # Configuration for Gemini (will be updated with tools)
-        self.generate_config = types.GenerateContentConfig(
-            temperature=0,
-            top_p=0.95,
-            max_output_tokens=8192,
-            response_modalities=["TEXT"],
+        self._set_generate_config(
+            types.GenerateContentConfig(
+                temperature=0,
+                top_p=0.95,
+                max_output_tokens=_ANSWER_MAX_TOKENS,
+                response_modalities=["TEXT"],
+            )
         )
 
         # Conversation history for chat
         self.chat = None
 
+        # Vertex context cache for the system instructions and tools, if available
+        self._gemini_tool: Optional[types.Tool] = None
+        self._gemini_tools_key = ""
+        self._cached_content: Optional[types.CachedContent] = None
+        self._cache_expires_at = 0.0
+
     async def connect_to_server(self, server_script_path: str):
         """Connect to an MCP server
 
@@ -75,154 +200,247 @@ class MCPClient:
         response = await self.session.list_tools()
         mcp_tools = response.tools
 
-        # Create function declarations for each MCP tool
-        function_declarations = []
-        for tool in mcp_tools:
-            # Convert the MCP tool schema to a Gemini function declaration
-            function_declaration = types.FunctionDeclaration(
-                name=tool.name,
-                description=tool.description,
-                parameters=types.Schema(
-                    type="OBJECT",
-                    properties=self._convert_schema_properties(
-                        tool.inputSchema.get("properties", {})
-                    ),
-                ),
+        # Reuse the Gemini Tool built for the same tool roster, e.g. on reconnect
+        tools_key = json.dumps(
+            [[tool.name, tool.description, tool.inputSchema] for tool in mcp_tools],
+            sort_keys=True,
+        )
+        tools_changed = self._gemini_tool is None or tools_key != self._gemini_tools_key
+        if tools_changed:
+            # Describe a function declaration for each MCP tool as plain data
+            function_declarations = [
+                {
+                    "name": tool.name,
+                    "description": tool.description,
+                    "parameters": {
+                        "type": "OBJECT",
+                        "properties": self._convert_schema_properties(
+                            tool.inputSchema.get("properties", {})
+                        ),
+                    },
+                }
+                for tool in mcp_tools
+            ]
+
+            # Create a Gemini Tool with all function declarations, validating the
+            # whole tree at once rather than one Schema model at a time
+            self._gemini_tool = types.Tool.model_validate(
+                {"function_declarations": function_declarations}
             )
-            function_declarations.append(function_declaration)
+            self._gemini_tools_key = tools_key
 
-        # Create a Gemini Tool with all function declarations
-        gemini_tool = types.Tool(function_declarations=function_declarations)
+        # Cache the system instructions and tools on the Vertex side so each turn
+        # doesn't prefill them again, replacing a cache holding stale tools
+        if tools_changed or self._cached_content is None:
+            await self._delete_cache()
+            self._set_generate_config(await self._create_cached_config())
 
-        # Define system instructions for the assistant
-        system_instructions = """
-        You are a helpful assistant with access to various tools. When a user's query requires the use of a tool,
-        use the appropriate tool to address their needs. Do not suggest using a tool when it's not necessary and 
-        answer queries not related to tools naturally.
-        """
+        # Initialize a chat session with the tools
+        self.chat = self.genai_client.aio.chats.create(
+            model=self.model, config=self.generate_config
+        )
+
+        # Print available tools
+        print("\nConnected to server with tools:", [tool.name for tool in mcp_tools])
 
-        self.generate_config = types.GenerateContentConfig(
+    def _set_generate_config(self, config: types.GenerateContentConfig):
+        """Use config for answers and a copy capped for the tool-picking turn"""
+        self.generate_config = config
+        self._cfg_toolpick = config.model_copy(
+            update={"max_output_tokens": _TOOLPICK_MAX_TOKENS}
+        )
+
+    def _uncached_config(self) -> types.GenerateContentConfig:
+        """Build a config sending the system instructions and tools inline"""
+        return types.GenerateContentConfig(
             temperature=0,
             top_p=0.95,
-            max_output_tokens=8192,
+            max_output_tokens=_ANSWER_MAX_TOKENS,
             response_modalities=["TEXT"],
-            tools=[gemini_tool],
-            system_instruction=system_instructions,
+            tools=[self._gemini_tool],
+            system_instruction=_SYSTEM_INSTRUCTIONS,
         )
 
-        # Initialize a chat session with the tools
-        self.chat = self.genai_client.chats.create(
-            model=self.model, config=self.generate_config
+    async def _create_cached_config(self) -> types.GenerateContentConfig:
+        """Build a config backed by a Vertex context cache
+
+        Falls back to sending the system instructions and tools inline when the
+        cache can't be created (e.g. the prefix is below the minimum cacheable
+        size or the project lacks the quota).
+        """
+        try:
+            self._cached_content = await self.genai_client.aio.caches.create(
+                model=self.model,
+                config=types.CreateCachedContentConfig(
+                    system_instruction=_SYSTEM_INSTRUCTIONS,
+                    tools=[self._gemini_tool],
+                    ttl=f"{_CACHE_TTL_SECONDS}s",
+                ),
+            )
+        except Exception as e:
+            print(f"Context cache unavailable, sending tools inline: {str(e)}")
+            self._cached_content = None
+            return self._uncached_config()
+
+        self._cache_expires_at = time.monotonic() + _CACHE_TTL_SECONDS
+        return types.GenerateContentConfig(
+            temperature=0,
+            top_p=0.95,
+            max_output_tokens=_ANSWER_MAX_TOKENS,
+            response_modalities=["TEXT"],
+            cached_content=self._cached_content.name,
         )
 
-        # Print available tools
-        print("\nConnected to server with tools:", [tool.name for tool in mcp_tools])
+    async def _refresh_cache(self):
+        """Extend the context cache TTL once half of it has elapsed
 
-    def _convert_schema_properties(self, properties: Dict) -> Dict[str, types.Schema]:
-        """Convert JSON Schema properties to Gemini Schema properties"""
+        If the cache can't be extended, the chat continues with the same history
+        and the system instructions and tools sent inline.
+        """
+        if self._cached_content is None:
+            return
+        if self._cache_expires_at - time.monotonic() > _CACHE_TTL_SECONDS / 2:
+            return
+
+        try:
+            await self.genai_client.aio.caches.update(
+                name=self._cached_content.name,
+                config=types.UpdateCachedContentConfig(ttl=f"{_CACHE_TTL_SECONDS}s"),
+            )
+            self._cache_expires_at = time.monotonic() + _CACHE_TTL_SECONDS
+        except Exception as e:
+            print(f"Failed to refresh context cache, sending tools inline: {str(e)}")
+            self._cached_content = None
+            self._set_generate_config(self._uncached_config())
+            self.chat = self.genai_client.aio.chats.create(
+                model=self.model,
+                config=self.generate_config,
+                history=self.chat.get_history(),
+            )
+
+    async def _delete_cache(self):
+        """Delete the context cache, if one was created"""
+        if self._cached_content is None:
+            return
+        try:
+            await self.genai_client.aio.caches.delete(name=self._cached_content.name)
+        except Exception as e:
+            print(f"Failed to delete context cache: {str(e)}")
+        self._cached_content = None
+
+    def _convert_schema_properties(self, properties: Dict) -> Dict[str, Dict[str, Any]]:
+        """Convert JSON Schema properties to Gemini Schema properties
+
+        Returns plain dicts in the shape of types.Schema, to be validated once
+        as part of the enclosing types.Tool.
+        """
         converted_properties = {}
 
         for prop_name, prop_schema in properties.items():
-            schema_type = self._map_json_schema_type(prop_schema.get("type", "string"))
-            schema_description = prop_schema.get("description", "")
+            schema_type = _map_json_schema_type(prop_schema.get("type", "string"))
+            converted = {
+                "type": schema_type,
+                "description": prop_schema.get("description", ""),
+            }
 
             # Handle nested objects
             if schema_type == "OBJECT" and "properties" in prop_schema:
-                nested_properties = self._convert_schema_properties(
+                converted["properties"] = self._convert_schema_properties(
                     prop_schema["properties"]
                 )
-                converted_properties[prop_name] = types.Schema(
-                    type=schema_type,
-                    description=schema_description,
-                    properties=nested_properties,
-                )
             # Handle arrays
             elif schema_type == "ARRAY" and "items" in prop_schema:
-                items_type = self._map_json_schema_type(
-                    prop_schema["items"].get("type", "string")
-                )
-                converted_properties[prop_name] = types.Schema(
-                    type=schema_type,
-                    description=schema_description,
-                    items=types.Schema(type=items_type),
-                )
-            # Handle simple types
-            else:
-                converted_properties[prop_name] = types.Schema(
-                    type=schema_type, description=schema_description
-                )
+                converted["items"] = {
+                    "type": _map_json_schema_type(
+                        prop_schema["items"].get("type", "string")
+                    )
+                }
 
-        return converted_properties
+            converted_properties[prop_name] = converted
 
-    def _map_json_schema_type(self, json_type: str) -> str:
-        """Map JSON Schema types to Gemini Schema types"""
-        type_mapping = {
-            "string": "STRING",
-            "number": "NUMBER",
-            "integer": "INTEGER",
-            "boolean": "BOOLEAN",
-            "object": "OBJECT",
-            "array": "ARRAY",
-        }
-        return type_mapping.get(json_type, "STRING")
+        return converted_properties
 
     async def process_query(self, query: str) -> str:
         """Process a query using Gemini and available tools with native function calling"""
+        # Skip Gemini entirely for greetings and thanks
+        reply = _trivial_reply(query)
+        if reply is not None:
+            return reply
+
         try:
-            # Send the query to Gemini
-            response = self.chat.send_message(query)
+            # Keep the context cache alive before using it
+            await self._refresh_cache()
+
+            # Send the query to Gemini with the tool-picking token cap
+            response = await self.chat.send_message(query, config=self._cfg_toolpick)
+
+            # Continue an answer cut off by the tool-picking token cap; the
+            # continuation may still call tools, so it is handled like the first turn
+            partial_text = ""
+            candidate = response.candidates[0] if response.candidates else None
+            if (
+                not response.function_calls
+                and candidate is not None
+                and candidate.finish_reason == types.FinishReason.MAX_TOKENS
+            ):
+                partial_text = _response_text(response)
+                response = await self.chat.send_message(_CONTINUE_PROMPT)
 
             # Check if there are function calls
             final_text = []
 
-            # If there are function calls, execute them
+            # If there are function calls, execute them concurrently
             if hasattr(response, "function_calls") and response.function_calls:
-                for function_call in response.function_calls:
-                    try:
-                        tool_name = function_call.name
-                        tool_args = function_call.args
-
-                        # Log the function call
-                        args_str = json.dumps(tool_args)
-                        final_text.append(
-                            f"[Calling tool {tool_name} with args {args_str}]"
-                        )
+                function_calls = response.function_calls
+                results = await asyncio.gather(
+                    *(
+                        self.session.call_tool(function_call.name, function_call.args)
+                        for function_call in function_calls
+                    ),
+                    return_exceptions=True,
+                )
 
-                        # Execute the tool call via MCP
-                        result = await self.session.call_tool(tool_name, tool_args)
-
-                        # Send the function result back to Gemini
-                        function_response = {
-                            "name": tool_name,
-                            "response": {"content": result.content},
-                        }
-
-                        message = f"""
-                            You used the tool {tool_name} to answer the query: {query}
-                    
-                            The tool returned this result: {result.content}
-                    
-                            Please provide a helpful response based on this information.
-                        """
-
-                        # Get Gemini's response to the function results
-                        response = self.chat.send_message(message)
-                    except Exception as e:
-                        error_message = f"Error executing tool {tool_name}: {str(e)}"
+                # Collect the results in the original call order
+                tool_results = []
+                for function_call, result in zip(function_calls, results):
+                    tool_name = function_call.name
+                    tool_args = function_call.args
+
+                    if isinstance(result, Exception):
+                        error_message = (
+                            f"Error executing tool {tool_name}: {str(result)}"
+                        )
                         final_text.append(error_message)
                         print(error_message)
-
-                        # Let Gemini know about the error
-                        function_response = {
-                            "name": tool_name,
-                            "response": {"error": str(e)},
-                        }
-                        response = self.chat.send_message(
-                            "", function_responses=[function_response]
+                        tool_results.append(
+                            f"The tool {tool_name} failed with this error: {str(result)}"
                         )
+                        continue
+
+                    # Log the function call
+                    args_str = _json_dumps(tool_args)
+                    final_text.append(
+                        f"[Calling tool {tool_name} with args {args_str}]"
+                    )
+                    tool_results.append(
+                        f"The tool {tool_name} returned this result: {result.content}"
+                    )
+
+                # Send all the tool results back to Gemini in a single message
+                message = (
+                    _TOOL_RESULTS_HEAD
+                    + query
+                    + "\n\n"
+                    + "\n\n".join(tool_results)
+                    + _TOOL_RESULTS_TAIL
+                )
 
-            # Add the final response text
-            final_text.append(response.text)
+                # Get Gemini's response to the function results
+                response = await self.chat.send_message(message)
+                final_text.append(_response_text(response))
+            else:
+                # Add the final response text, joined to any text before the cap
+                final_text.append(partial_text + _response_text(response))
             return "\n".join(final_text)
 
         except Exception as e:
@@ -237,7 +455,12 @@ class MCPClient:
 
         while True:
             try:
-                query = input("\nQuery: ").strip()
+                # Read stdin in a thread so background tasks keep running
+                print("\nQuery: ", end="", flush=True)
+                line = await _read_line()
+                if not line:  # EOF
+                    break
+                query = line.strip()
                 if query.lower() == "quit":
                     break
 
@@ -249,6 +472,7 @@ class MCPClient:
 
     async def cleanup(self):
         """Clean up resources"""
+        await self._delete_cache()
         await self.exit_stack.aclose()
 
 
@@ -0,0 +1,367 @@
+import asyncio
+import io
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+from google.genai import types
+
+import client_gemini
+import client_gemini_function_call
+
+
+@pytest.fixture
+def client():
+    with mock.patch.object(client_gemini.genai, "Client"):
+        return client_gemini.MCPClient()
+
+
+@pytest.fixture
+def function_call_client():
+    with mock.patch.object(client_gemini_function_call.genai, "Client"):
+        client = client_gemini_function_call.MCPClient()
+    client._gemini_tool = types.Tool(
+        function_declarations=[types.FunctionDeclaration(name="forecast")]
+    )
+    return client
+
+
+def _tool_calls(client, text):
+    _, bodies = client_gemini._ToolCallScanner().feed(text)
+    return client._parse_tool_calls(bodies)
+
+
+def test_tool_calls_finds_every_call(client):
+    text = (
+        'First <tool_call>{"name": "a", "input": {"x": 1}}</tool_call> then\n'
+        "<tool_call>\n"
+        '{"name": "b", "input": {}}\n'
+        "</tool_call> done"
+    )
+    assert _tool_calls(client, text) == [
+        {"name": "a", "input": {"x": 1}},
+        {"name": "b", "input": {}},
+    ]
+
+
+def test_tool_calls_ignores_unclosed_call(client):
+    text = '<tool_call>{"name": "a"}</tool_call> <tool_call>{"name": "b"}'
+    assert _tool_calls(client, text) == [{"name": "a"}]
+
+
+def test_tool_calls_skips_bad_json(client):
+    text = '<tool_call>{"name": </tool_call><tool_call>{"name": "b"}</tool_call>'
+    assert _tool_calls(client, text) == [{"name": "b"}]
+
+
+def test_tool_calls_skips_non_object_body(client):
+    text = '<tool_call>["a"]</tool_call><tool_call>{"name": "b"}</tool_call>'
+    assert _tool_calls(client, text) == [{"name": "b"}]
+
+
+def test_scanner_joins_tags_split_across_chunks():
+    scanner = client_gemini._ToolCallScanner()
+    chunks = ["Sure <tool", '_call>{"name": "a"}</tool_', "call> done <", "x"]
+    visible, bodies = [], []
+    for chunk in chunks:
+        text, new_bodies = scanner.feed(chunk)
+        visible.append(text)
+        bodies.extend(new_bodies)
+    visible.append(scanner.flush())
+
+    assert "".join(visible) == "Sure  done <x"
+    assert bodies == ['{"name": "a"}']
+
+
+def _text_chunk(text, finish_reason=None):
+    return types.GenerateContentResponse(
+        candidates=[
+            types.Candidate(
+                content=types.Content(role="model", parts=[types.Part(text=text)]),
+                finish_reason=finish_reason,
+            )
+        ]
+    )
+
+
+class _FakeChat:
+    """Stream canned turns, logging events next to the tool calls"""
+
+    def __init__(self, turns, events, finish_reasons=()):
+        self.turns = turns
+        self.events = events
+        self.finish_reasons = list(finish_reasons)
+        self.messages = []
+
+    async def send_message_stream(self, message, config=None):
+        self.messages.append(message)
+        chunks = self.turns.pop(0)
+        finish_reason = self.finish_reasons.pop(0) if self.finish_reasons else None
+
+        async def stream():
+            for i, chunk in enumerate(chunks):
+                await asyncio.sleep(0)
+                self.events.append(f"chunk {chunk}")
+                last = i == len(chunks) - 1
+                yield _text_chunk(chunk, finish_reason if last else None)
+
+        return stream()
+
+
+def test_process_query_starts_tool_before_stream_ends(client):
+    events = []
+    client.chat = _FakeChat(
+        [
+            ["Let me <tool_", 'call>{"name": "t", "input": {}}</tool', "_call>", "."],
+            ["Answer"],
+        ],
+        events,
+    )
+
+    async def call_tool(name, args):
+        events.append(f"tool {name}")
+        return SimpleNamespace(content="42")
+
+    client.session = SimpleNamespace(call_tool=call_tool)
+
+    streamed = []
+    response = asyncio.run(client.process_query("q", on_text=streamed.append))
+
+    assert events.index("tool t") < events.index("chunk .")
+    assert "".join(streamed) == "Let me .\n[Calling tool t with args {}]\nAnswer"
+    assert response == "[Calling tool t with args {}]\nAnswer"
+
+
+def test_process_query_sends_repeated_queries_to_chat(client):
+    events = []
+    client.chat = _FakeChat([["Paris is sunny."], ["Still sunny."]], events)
+
+    first = asyncio.run(client.process_query("weather in Paris"))
+    second = asyncio.run(client.process_query("weather in Paris"))
+
+    assert (first, second) == ("Paris is sunny.", "Still sunny.")
+    assert events == ["chunk Paris is sunny.", "chunk Still sunny."]
+    client.genai_client.aio.models.embed_content.assert_not_called()
+
+
+def test_cached_config_uses_the_context_cache(function_call_client):
+    client = function_call_client
+    client.genai_client.aio.caches.create = mock.AsyncMock(
+        return_value=SimpleNamespace(name="cachedContents/1")
+    )
+
+    config = asyncio.run(client._create_cached_config())
+
+    assert config.cached_content == "cachedContents/1"
+    assert config.tools is None and config.system_instruction is None
+
+
+def test_cached_config_falls_back_to_inline_tools(function_call_client):
+    client = function_call_client
+    client.genai_client.aio.caches.create = mock.AsyncMock(
+        side_effect=RuntimeError("quota exceeded")
+    )
+
+    config = asyncio.run(client._create_cached_config())
+
+    assert config == client._uncached_config()
+    assert client._cached_content is None
+
+
+def test_refresh_cache_failure_rebuilds_chat_with_history(function_call_client):
+    client = function_call_client
+    client._cached_content = SimpleNamespace(name="cachedContents/1")
+    client._cache_expires_at = 0.0
+    client.genai_client.aio.caches.update = mock.AsyncMock(
+        side_effect=RuntimeError("cache expired")
+    )
+    history = [types.Content(role="user", parts=[types.Part(text="hi")])]
+    client.chat = mock.Mock(get_history=mock.Mock(return_value=history))
+
+    asyncio.run(client._refresh_cache())
+
+    assert client._cached_content is None
+    assert client.generate_config == client._uncached_config()
+    assert client._cfg_toolpick.max_output_tokens == (
+        client_gemini_function_call._TOOLPICK_MAX_TOKENS
+    )
+    client.genai_client.aio.chats.create.assert_called_once_with(
+        model=client.model, config=client.generate_config, history=history
+    )
+    assert client.chat is client.genai_client.aio.chats.create.return_value
+
+
+def test_convert_schema_properties_nests_objects_and_arrays(function_call_client):
+    properties = {
+        "where": {
+            "type": "object",
+            "properties": {"city": {"type": "string", "description": "City"}},
+        },
+        "days": {"type": "array", "items": {"type": "integer"}},
+    }
+
+    converted = function_call_client._convert_schema_properties(properties)
+    tool = types.Tool.model_validate(
+        {
+            "function_declarations": [
+                {
+                    "name": "forecast",
+                    "parameters": {"type": "OBJECT", "properties": converted},
+                }
+            ]
+        }
+    )
+
+    schema = tool.function_declarations[0].parameters.properties
+    assert schema["where"].type == types.Type.OBJECT
+    assert schema["where"].properties["city"].type == types.Type.STRING
+    assert schema["where"].properties["city"].description == "City"
+    assert schema["days"].type == types.Type.ARRAY
+    assert schema["days"].items.type == types.Type.INTEGER
+
+
+def test_process_query_continues_a_cut_off_tool_call(client):
+    events = []
+    client.chat = _FakeChat(
+        [
+            ['<tool_call>{"name": "a", "input": {}}</tool_call><tool_call>{"na'],
+            ['me": "b", "input": {}}</tool_call>'],
+            ["Both done."],
+        ],
+        events,
+        finish_reasons=[types.FinishReason.MAX_TOKENS],
+    )
+
+    async def call_tool(name, args):
+        events.append(f"tool {name}")
+        return SimpleNamespace(content=name)
+
+    client.session = SimpleNamespace(call_tool=call_tool)
+
+    response = asyncio.run(client.process_query("q"))
+
+    assert client.chat.messages[1] == client_gemini._CONTINUE_PROMPT
+    assert "tool a" in events and "tool b" in events
+    assert response.endswith("Both done.")
+
+
+def test_scanner_reports_a_tool_call_left_cut_off(capsys):
+    scanner = client_gemini._ToolCallScanner()
+    scanner.feed('Sure <tool_call>{"name": "a"')
+
+    assert scanner.in_call
+    assert scanner.flush() == ""
+    assert "cut off" in capsys.readouterr().out
+
+
+def _model_response(*parts, finish_reason=None):
+    return types.GenerateContentResponse(
+        candidates=[
+            types.Candidate(
+                content=types.Content(role="model", parts=list(parts)),
+                finish_reason=finish_reason,
+            )
+        ]
+    )
+
+
+class _FakeSendChat:
+    """Answer each message with the next canned response"""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.messages = []
+
+    async def send_message(self, message, config=None):
+        self.messages.append(message)
+        return self.responses.pop(0)
+
+
+def test_function_results_keep_call_order(function_call_client):
+    client = function_call_client
+    client.chat = _FakeSendChat(
+        [
+            _model_response(
+                types.Part.from_function_call(name="slow", args={"n": 1}),
+                types.Part.from_function_call(name="broken", args={}),
+            ),
+            _model_response(types.Part(text="Done.")),
+        ]
+    )
+
+    async def call_tool(name, args):
+        if name == "broken":
+            raise RuntimeError("boom")
+        await asyncio.sleep(0.01)
+        return SimpleNamespace(content="1")
+
+    client.session = SimpleNamespace(call_tool=call_tool)
+
+    response = asyncio.run(client.process_query("go"))
+
+    assert response.splitlines() == [
+        '[Calling tool slow with args {"n":1}]',
+        "Error executing tool broken: boom",
+        "Done.",
+    ]
+    results = client.chat.messages[1]
+    assert results.index("The tool slow returned") < results.index(
+        "The tool broken failed"
+    )
+
+
+@pytest.mark.parametrize("module", [client_gemini, client_gemini_function_call])
+def test_read_line_returns_stdin_line(module, monkeypatch):
+    monkeypatch.setattr(module.sys, "stdin", io.StringIO("hello\n"))
+    assert asyncio.run(asyncio.wait_for(module._read_line(), 5)) == "hello\n"
+
+
+@pytest.mark.parametrize("module", [client_gemini, client_gemini_function_call])
+def test_read_line_raises_stdin_errors(module, monkeypatch):
+    stdin = io.StringIO()
+    stdin.close()
+    monkeypatch.setattr(module.sys, "stdin", stdin)
+    with pytest.raises(ValueError):
+        asyncio.run(asyncio.wait_for(module._read_line(), 5))
+
+
+def test_function_call_after_continuation_is_run(function_call_client):
+    client = function_call_client
+    client.chat = _FakeSendChat(
+        [
+            _model_response(
+                types.Part(text="Let me"),
+                finish_reason=types.FinishReason.MAX_TOKENS,
+            ),
+            _model_response(types.Part.from_function_call(name="forecast", args={})),
+            _model_response(types.Part(text="Sunny.")),
+        ]
+    )
+    calls = []
+
+    async def call_tool(name, args):
+        calls.append(name)
+        return SimpleNamespace(content="sun")
+
+    client.session = SimpleNamespace(call_tool=call_tool)
+
+    response = asyncio.run(client.process_query("weather?"))
+
+    assert calls == ["forecast"]
+    assert client.chat.messages[1] == client_gemini_function_call._CONTINUE_PROMPT
+    assert response.splitlines() == ["[Calling tool forecast with args {}]", "Sunny."]
+
+
+def test_continued_answer_is_joined(function_call_client):
+    client = function_call_client
+    client.chat = _FakeSendChat(
+        [
+            _model_response(
+                types.Part(text="Once upon"),
+                finish_reason=types.FinishReason.MAX_TOKENS,
+            ),
+            _model_response(types.Part(text=" a time.")),
+        ]
+    )
+
+    assert asyncio.run(client.process_query("story")) == "Once upon a time."